@@ -11,9 +11,11 @@ class Auth:
 class LocalModeXTokenAuth:
     def __init__(self, lfdi: str):
         self.lfdi = lfdi
+        # Convert to integer once, as this is what is checked against
+        self._token = str(int(lfdi, 16))
 
     def inject_headers(self, header):
-        header["X-Token"] = self.lfdi
+        header["X-Token"] = self._token
 
     def update_session(self, session: Session) -> None:
         """Update the transport layer with appropriate session headers to pass through
@@ -22,8 +24,7 @@ class LocalModeXTokenAuth:
         Args:
             session (Session): Transport `Session` object
         """
-        # Convert to integer as this is what is checked against
-        session.headers['X-Token'] = str(int(self.lfdi, 16))
+        session.headers['X-Token'] = self._token
         session.headers['X-Forwarded-Client-Cert'] = ""  # Required for local auth
 
 
@@ -1,13 +1,16 @@
 from envoy_client.models.smart_energy import MirrorMeterReading, MirrorUsagePoint
-from typing import List, Optional
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import cached_property
+from threading import Lock
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 
-import xmltodict
 import requests
 
 from .transport import Transport
 from .auth import Auth
 from .models import DER, DeviceCategoryType, DeviceInformation, EndDevice, EndDeviceList, \
-    DERCapability, ConnectionPoint
+    DERCapability, ConnectionPoint, parse_xml
 
 import logging
 logger = logging.getLogger(__name__)
@@ -27,74 +30,320 @@ def trailing_resource_id_from_response(response: requests.Response) -> int:
     Returns:
         int: resource ID
     """
-    if hasattr(response, 'headers'):
-        if 'location' in response.headers:
-            return int(response.headers['location'].split('/')[-1])
-    raise ValueError('Response object has no location resource.')
+    location = response.headers.get('location')
+    if location is None:
+        raise ValueError('Response object has no location resource.')
+    return int(location.rpartition('/')[2])
 
 class EndDeviceInterface:
     """A 2030.5 client interface that functions according to the Common Smart Inverter Profile.
     """
+    # Resource paths on the utility server, relative to the transport base URL
+    END_DEVICE_LIST_PATH = '/edev'
+    PAGED_END_DEVICE_LIST_PATH = '/edev?s={start}&l={limit}'
+    END_DEVICE_PATH = '/edev/{edev_id}'
+    DEVICE_INFORMATION_PATH = '/edev/{edev_id}/di'
+    DER_LIST_PATH = '/edev/{edev_id}/der'
+    DER_CAPABILITY_PATH = '/edev/{edev_id}/der/{der_id}/dercap'
+    CONNECTION_POINT_PATH = '/edev/{edev_id}/cp'
+    MIRROR_USAGE_POINT_LIST_PATH = '/mup'
+    MIRROR_USAGE_POINT_PATH = '/mup/{mup_id}'
+    # Maximum number of parsed responses retained for conditional requests
+    RESPONSE_CACHE_SIZE = 4096
+
     def __init__(self, transport: Transport, lfdi: str) -> None:
         self.transport = transport
         self.lfdi = lfdi
+        # Conditional request headers and parsed object of the last response, keyed by path
+        # and ordered from least to most recently used
+        self._response_cache: 'OrderedDict[str, Tuple[Dict[str, str], Any]]' = OrderedDict()
+        # Guards `_response_cache`, which is shared with prefetching and sync worker threads
+        self._response_cache_lock = Lock()
         self.transport.connect()
 
-    def get_end_devices(self, include_self=False) -> Optional[EndDeviceList]:
+    def __enter__(self) -> 'EndDeviceInterface':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """Close the underlying transport (and any pooled connections)"""
+        self.transport.close()
+
+    def _max_workers(self, max_workers: int) -> int:
+        """Limit the number of concurrent requests to the size of the transport connection
+        pool, so that worker threads do not block waiting for a pooled connection.
+        """
+        return min(max_workers, getattr(self.transport, 'pool_maxsize', max_workers))
+
+    def _conditional_get(self, path: str, revalidate: bool) -> Tuple[requests.Response, Any]:
+        """Request `path` (streamed), revalidating a previously retrieved response if any.
+
+        Args:
+            revalidate (bool): Make the request conditional on a cached response. If False,
+                the response cache is not consulted.
+
+        Returns:
+            Tuple of the response and, if the server reports the resource as not modified
+            (`304: NOT MODIFIED`), a copy of the previously parsed object. Otherwise `None`.
+        """
+        if not revalidate:
+            return self.transport.get(path, stream=True), None
+        with self._response_cache_lock:
+            cached = self._response_cache.get(path)
+            if cached is not None:
+                self._response_cache.move_to_end(path)
+        headers, value = cached or (None, None)
+        response = self.transport.get(path, stream=True, headers=headers)
+        if response.status_code == 304:
+            response.close()
+            return response, self._copy_cached(value)
+        return response, None
+
+    @staticmethod
+    def _copy_cached(value: Any) -> Any:
+        """Deep copy a cached parsed object (a model, or a page of `EndDevice`s and the 
+        reported total), so that callers never share (and can't modify) the cached instance
+        """
+        if value is None:
+            return None
+        if isinstance(value, tuple):
+            end_devices, total = value
+            return [end_device.copy(deep=True) for end_device in end_devices], total
+        return value.copy(deep=True)
+
+    def _cache_response(self, path: str, response: requests.Response, value: Any) -> None:
+        """Store the parsed `value` of `response` if the server supplied cache validators, 
+        so that a subsequent `304: NOT MODIFIED` can be served without re-parsing.
+        """
+        headers = {}
+        etag = response.headers.get('ETag')
+        if etag:
+            headers['If-None-Match'] = etag
+        last_modified = response.headers.get('Last-Modified')
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+        with self._response_cache_lock:
+            if headers:
+                # A copy is kept, as `value` itself is returned to the caller
+                self._response_cache[path] = (headers, self._copy_cached(value))
+                self._response_cache.move_to_end(path)
+                if len(self._response_cache) > self.RESPONSE_CACHE_SIZE:
+                    self._response_cache.popitem(last=False)
+            else:
+                self._response_cache.pop(path, None)
+
+    def _invalidate_end_device(self, edev_id: Optional[int] = None) -> None:
+        """Discard cached responses affected by a change to the `EndDevice` with ID `edev_id`
+        (or by the creation of a new `EndDevice` if `edev_id` is `None`). Called once the
+        write has returned, so that a read made concurrently with the write cannot leave the
+        stale representation cached.
+        """
+        page_prefix = self.PAGED_END_DEVICE_LIST_PATH.partition('?')[0] + '?'
+        with self._response_cache_lock:
+            self._response_cache.pop(self.END_DEVICE_LIST_PATH, None)
+            for path in [path for path in self._response_cache if path.startswith(page_prefix)]:
+                del self._response_cache[path]
+            if edev_id is not None:
+                self._response_cache.pop(self.END_DEVICE_PATH.format(edev_id=edev_id), None)
+
+    def _read_end_devices(self, response: requests.Response) -> Tuple[List[EndDevice], Optional[int]]:
+        """Parse each `EndDevice` in an `EndDeviceList` response as it is read, rather than
+        materialising the full body.
+
+        Returns:
+            Tuple of the `EndDevice`s in the response and the `all` attribute of the list 
+            (the total number of `EndDevice`s available on the server), if present
+        """
+        end_devices: List[EndDevice] = []
+        list_attributes: Dict[str, str] = {}
+
+        def append_end_device(path: list, item: dict) -> bool:
+            list_attributes.update(path[0][1] or {})
+            end_devices.append(EndDevice.from_dict(item))
+            return True
+
+        response.raw.decode_content = True
+        try:
+            parse_xml(response.raw, item_depth=2, item_callback=append_end_device)
+        finally:
+            response.close()
+        logger.debug('Read %d EndDevices from %s', len(end_devices), response.request.url)
+        total = list_attributes.get('all')
+        return end_devices, int(total) if total is not None else None
+
+    def get_end_devices(self, include_self: bool = False, revalidate: bool = False) -> Optional[EndDeviceList]:
         """Retrieve all associated `EndDevice`s.
 
-        # TODO This currently retrieves all devices in one query. At scale, this should
-        be paginated
+        This retrieves all devices in one query. At scale, `get_paged_end_devices` should
+        be used instead.
 
         Args:
             include_self (bool, optional): Whether to include or ignore the first device, which
                 will represent the aggregator. Defaults to False.
+            revalidate (bool, optional): Keep the parsed list so that a later call can 
+                revalidate it. Defaults to False, as the full list is held in memory.
         
         Returns:
-            List of `EndDevice`s (as an `EndDeviceList`)
+            List of `EndDevice`s (as an `EndDeviceList`). If `revalidate` is set and the 
+            server reports the list as not modified, a copy of the previously parsed list 
+            is returned (the cached list is never shared with the caller).
         """
-        response = self.transport.get('/edev')
-        if response:
-            response_dct = xmltodict.parse(response.content)['EndDeviceList']
-            if 'EndDevice' not in response_dct:
+        path = self.END_DEVICE_LIST_PATH
+        response, cached = self._conditional_get(path, revalidate)
+        try:
+            if response.status_code == 304:
+                return cached
+            if not response:
+                logger.warning(f'Retrieving EndDevices returned {response.status_code}')
+                return None
+            end_devices, _ = self._read_end_devices(response)
+            if not end_devices:
                 logger.warning('No EndDevices returned in response')
+                if revalidate:
+                    self._cache_response(path, response, None)
                 return None
-            end_device_list = EndDeviceList(**response_dct)
+            end_device_list = EndDeviceList(end_device=end_devices)
+            if revalidate:
+                self._cache_response(path, response, end_device_list)
             return end_device_list
+        finally:
+            response.close()
+
+    def _get_end_device_page(self, start: int, page_size: int, 
+                             revalidate: bool = False) -> Optional[Tuple[List[EndDevice], Optional[int]]]:
+        """Retrieve the page of (at most `page_size`) `EndDevice`s starting from index `start`
+
+        Args:
+            revalidate (bool, optional): Cache the parsed page and revalidate it on subsequent
+                requests. Defaults to False.
+
+        Returns:
+            Tuple of the `EndDevice`s in the page and the total number of `EndDevice`s
+            available (if reported by the server), or `None` if the request failed
+        """
+        path = self.PAGED_END_DEVICE_LIST_PATH.format(start=start, limit=page_size)
+        response, cached = self._conditional_get(path, revalidate)
+        if response.status_code == 304:
+            return cached
+        if not response:
+            logger.warning(f'Retrieving EndDevices from {start} returned {response.status_code}')
+            response.close()
+            return None
+        page = self._read_end_devices(response)
+        if revalidate:
+            self._cache_response(path, response, page)
+        return page
+
+    def get_paged_end_devices(self, include_self=False, page_size: int = 100, prefetch: bool = True, 
+                              max_end_devices: Optional[int] = None, 
+                              revalidate: bool = False) -> Iterator[EndDevice]:
+        """Retrieve all associated `EndDevice`s, one page at a time, so iteration can be 
+        stopped early. While a page is being consumed, the next page is requested in the
+        background (if `prefetch` is set), so that the request latency is hidden.
+
+        Args:
+            include_self (bool, optional): Whether to include the `EndDevice` representing
+                the aggregator. Defaults to False.
+            page_size (int, optional): Number of `EndDevice`s to request per page. Defaults to 100.
+            prefetch (bool, optional): Request the next page while the current page is 
+                consumed. If False, each page is only requested once the previous page has
+                been consumed. Defaults to True.
+            max_end_devices (int, optional): Stop after this many `EndDevice`s, without 
+                requesting (or prefetching) pages beyond those needed. Defaults to None (all).
+            revalidate (bool, optional): Keep each parsed page so that a later iteration can
+                revalidate it, reusing pages the server reports as not modified. Only suited
+                to repeated polling of a small list, as every page is held in memory. 
+                Defaults to False.
+
+        Yields:
+            `EndDevice`s in the order returned by the server
+        """
+        if max_end_devices is not None and max_end_devices <= 0:
+            return
+        self_lfdi = int(self.lfdi, 16)
+        start = 0
+        count = 0
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            page = self._get_end_device_page(start, page_size, revalidate)
+            while page is not None:
+                page_end_devices, total = page
+                start += len(page_end_devices)
+                # Servers may return fewer than `page_size` items, so where the total is reported
+                # a short page doesn't mark the end of the list
+                if total is not None:
+                    has_next_page = bool(page_end_devices) and start < total
+                else:
+                    has_next_page = len(page_end_devices) >= page_size
+                end_devices = [end_device for end_device in page_end_devices
+                               if include_self or int(end_device.lfdi, 16) != self_lfdi]
+                # Don't request further pages when this page already completes `max_end_devices`
+                if max_end_devices is not None and count + len(end_devices) >= max_end_devices:
+                    has_next_page = False
+                next_page = None
+                if has_next_page and prefetch:
+                    next_page = executor.submit(self._get_end_device_page, start, page_size, revalidate)
+                for end_device in end_devices:
+                    yield end_device
+                    count += 1
+                    if count == max_end_devices:
+                        return
+                if not has_next_page:
+                    return
+                page = next_page.result() if next_page else self._get_end_device_page(start, page_size, revalidate)
 
     def create_end_device(self, end_device: EndDevice) -> requests.Response:
         """Register a 2030.5 `EndDevice` on the server
         """
-        return self.transport.post('/edev', end_device.to_xml(mode='create'))
+        try:
+            return self.transport.post(self.END_DEVICE_LIST_PATH, end_device.to_xml(mode='create'))
+        finally:
+            self._invalidate_end_device()
 
     def update_end_device(self, end_device: EndDevice, edev_id: int) -> requests.Response:
         """Update an EndDevice"""
         # TODO Untested
-        return self.transport.put(f'/edev/{edev_id}', end_device.to_xml('create'))
+        try:
+            return self.transport.put(self.END_DEVICE_PATH.format(edev_id=edev_id), end_device.to_xml('create'))
+        finally:
+            self._invalidate_end_device(edev_id)
 
     def create_device_information(self, device_information: DeviceInformation, edev_id: int):
         """Create or update an `EndDevice` `DeviceInformation` object
         """
-        return self.transport.put(f'/edev/{edev_id}/di', device_information.to_xml(mode='create'))
+        try:
+            return self.transport.put(self.DEVICE_INFORMATION_PATH.format(edev_id=edev_id), device_information.to_xml(mode='create'))
+        finally:
+            self._invalidate_end_device(edev_id)
 
     def create_der(self, der: DER, edev_id: int) -> requests.Response:
         """Create a new `DER` container associated with `EndDevice` with ID `edev_id`
         """
-        return self.transport.post(f'/edev/{edev_id}/der', der.to_xml(mode='create'))
+        try:
+            return self.transport.post(self.DER_LIST_PATH.format(edev_id=edev_id), der.to_xml(mode='create'))
+        finally:
+            self._invalidate_end_device(edev_id)
 
     def create_der_capability(self, der_capability: DERCapability, edev_id: int, der_id: int) -> requests.Response:
         """Create or update a `DER` `DERCapability` object associated with `DER` with ID `der_id`
         and `EndDevice` with ID `edev_id`
         """
-        return self.transport.put(f'/edev/{edev_id}/der/{der_id}/dercap', der_capability.to_xml(mode='create'))
+        try:
+            return self.transport.put(self.DER_CAPABILITY_PATH.format(edev_id=edev_id, der_id=der_id), der_capability.to_xml(mode='create'))
+        finally:
+            self._invalidate_end_device(edev_id)
 
     def create_connection_point(self, connection_point: ConnectionPoint, edev_id: int) -> requests.Response:
         """Create a `ConnectionPoint` object on the server associated with `EndDevice` with
         ID `edev_id`. Note: this is an extension to the 2030.5 spec.
         """
-        return self.transport.put(f'/edev/{edev_id}/cp', connection_point.to_xml(mode='create'))
+        try:
+            return self.transport.put(self.CONNECTION_POINT_PATH.format(edev_id=edev_id), connection_point.to_xml(mode='create'))
+        finally:
+            self._invalidate_end_device(edev_id)
     
-    @property
+    @cached_property
     def self_device(self):
         """The `EndDevice` associated with the AggregatorClient.
         """
@@ -105,15 +354,30 @@ class EndDeviceInterface:
         """
         return self.create_end_device(self.self_device)
 
-    def get_end_device(self, edev_id: int) -> Optional[EndDevice]:
-        """Retrieve an `EndDevice` object from the server with ID `edev_id`"""
-        response = self.transport.get(f'/edev/{edev_id}')
-        if response.status_code == 200:
-            return EndDevice.from_xml(response.content)
+    def get_end_device(self, edev_id: int, revalidate: bool = False) -> Optional[EndDevice]:
+        """Retrieve an `EndDevice` object from the server with ID `edev_id`. If `revalidate` 
+        is set, the parsed `EndDevice` is kept, and if the server later reports it as not 
+        modified, a copy of the previously parsed `EndDevice` is returned (the cached 
+        instance is never shared with the caller).
+        """
+        path = self.END_DEVICE_PATH.format(edev_id=edev_id)
+        response, cached = self._conditional_get(path, revalidate)
+        try:
+            if response.status_code == 304:
+                return cached
+            if response.status_code == 200:
+                # Parse directly from the response stream rather than a copy of the full body
+                response.raw.decode_content = True
+                end_device = EndDevice.from_xml(response.raw)
+                if revalidate:
+                    self._cache_response(path, response, end_device)
+                return end_device
+        finally:
+            response.close()
         logger.warning(f'No EndDevice found with edevID {edev_id}')
         return None
 
-    def sync_end_device(self, end_device: EndDevice, edev_id: Optional[int]=None, create_nested: bool=False):
+    def sync_end_device(self, end_device: EndDevice, edev_id: Optional[int]=None, create_nested: bool=False, verify: bool=False):
         """Check if an `EndDevice` is already registered on the server. If not, create 
         the `EndDevice` and (optionally) all nested objects.
 
@@ -122,9 +386,12 @@ class EndDeviceInterface:
             edev_id (int, optional): Resource ID of `EndDevice` if it already exists. 
             If `None`, creates a new `EndDevice`. Defaults to None.
             create_nested (bool, optional): Create nested objects (e.g. `DER`, `DeviceInformation`). Defaults to False.
+            verify (bool, optional): Retrieve the `EndDevice` from the server and check that it 
+                matches `end_device` before creating nested objects. Defaults to False.
 
         Raises:
-            ValueError: Raised when request to create `EndDevice` fails.
+            ValueError: Raised when request to create `EndDevice` fails, or when `verify` is
+                set and the `EndDevice` on the server does not match.
         """
         if edev_id is None:
             logger.info('No edevID supplied. Attempting to create EndDevice')
@@ -134,48 +401,105 @@ class EndDeviceInterface:
             else:
                 raise ValueError(f'Attempt to create EndDevice returned {response.status_code}: {response.content}')
         
-        server_end_device = self.get_end_device(edev_id)
+        if verify:
+            server_end_device = self.get_end_device(edev_id)
+            if server_end_device is None or int(server_end_device.lfdi, 16) != int(end_device.lfdi, 16):
+                raise ValueError(f'EndDevice with edevID {edev_id} does not match the supplied EndDevice')
 
         if create_nested:
-            self.create_device_information(end_device.device_information, edev_id=edev_id)
+            self.create_nested_resources(end_device, edev_id)
 
-            for der in end_device.der:
-                response = self.create_der(der, edev_id=edev_id)
-                if response.status_code > 201:
-                    logger.warning(f'DER could not be created for EndDevice {edev_id}')
-                der_id = trailing_resource_id_from_response(response)
-                if der.der_capability:
-                    response = self.create_der_capability(der.der_capability, edev_id, der_id)
+    def _create_der_with_capability(self, der: DER, edev_id: int) -> None:
+        """Create a `DER` container and its `DERCapability` (if supplied). These are
+        created in sequence as the `DERCapability` location depends on the created `DER`.
+        """
+        response = self.create_der(der, edev_id=edev_id)
+        if response.status_code > 201:
+            logger.warning(f'DER could not be created for EndDevice {edev_id}')
+            return
+        der_id = trailing_resource_id_from_response(response)
+        if der.der_capability:
+            self.create_der_capability(der.der_capability, edev_id, der_id)
+
+    def create_nested_resources(self, end_device: EndDevice, edev_id: int, max_workers: int = 8) -> None:
+        """Create the objects nested under an existing `EndDevice` with ID `edev_id` (i.e.
+        `DeviceInformation`, each `DER` and its `DERCapability` and the `ConnectionPoint`).
+        Independent resources are submitted concurrently over the transport's pooled 
+        connections.
 
+        Args:
+            end_device (EndDevice): `EndDevice` containing the nested objects to create
+            edev_id (int): Resource ID of the `EndDevice` on the server
+            max_workers (int, optional): Maximum number of concurrent requests. Defaults to 8.
+        """
+        with ThreadPoolExecutor(max_workers=self._max_workers(max_workers)) as executor:
+            futures = []
+            if end_device.device_information:
+                futures.append(executor.submit(self.create_device_information, end_device.device_information, edev_id))
+            for der in end_device.der or []:
+                futures.append(executor.submit(self._create_der_with_capability, der, edev_id))
             if end_device.connection_point:
-                self.create_connection_point(end_device.connection_point, edev_id)
-
-        
-
-    
-    def sync_end_devices(self, end_devices: List[EndDevice], create_der=False, abort_on_error=True) -> None:
+                futures.append(executor.submit(self.create_connection_point, end_device.connection_point, edev_id))
+            try:
+                for future in futures:
+                    future.result()
+            except Exception:
+                self._cancel_futures(futures)
+                raise
+
+    def sync_end_devices(self, end_devices: List[EndDevice], create_der: bool = False, abort_on_error: bool = True, max_workers: int = 8) -> List[Optional[requests.Response]]:
         """Create the complete `EndDeviceList` on the server. This assumes all
         devices are to be created and will (optionally) create all DER linked to these
         devices.
 
-        This function adds each `EndDevice` in an individual call.
+        This function adds each `EndDevice` in an individual call. Calls are dispatched
+        concurrently over the transport's pooled connections, with at most `max_workers`
+        (or the transport connection pool size, if smaller) requests in flight.
 
         Args:
             end_device_list (EndDeviceList): `EndDeviceList` to add.
             create_der (bool): Optionally create linked `DER` assets in addition to the 
                 `EndDevice`
-            abort_on_error (bool): Abort creation of devices after first error
+            abort_on_error (bool): Abort creation of devices after first error. Requests not
+                yet started are cancelled, but those already in flight (up to `max_workers`)
+                still complete and their responses are returned.
+            max_workers (int): Maximum number of concurrent requests. Defaults to 8.
+
+        Returns:
+            The response for each `EndDevice`, in the same order as `end_devices`. 
+            Entries are `None` for `EndDevice`s that were not submitted after an error.
         """
-        errors = []
-        for end_device in end_devices: 
-            self.create_end_device(end_device)
-        return
+        responses: List[Optional[requests.Response]] = []
+        with ThreadPoolExecutor(max_workers=self._max_workers(max_workers)) as executor:
+            futures = [executor.submit(self.create_end_device, end_device) for end_device in end_devices]
+            for end_device, future in zip(end_devices, futures):
+                if future.cancelled():
+                    responses.append(None)
+                    continue
+                try:
+                    response = future.result()
+                except Exception:
+                    # Don't send the queued requests while the executor waits to shut down
+                    self._cancel_futures(futures)
+                    raise
+                responses.append(response)
+                if response.status_code > 201:
+                    logger.warning(f'Attempt to create EndDevice {end_device.lfdi} returned {response.status_code}')
+                    if abort_on_error:
+                        self._cancel_futures(futures)
+        return responses
+
+    @staticmethod
+    def _cancel_futures(futures: List[Future]) -> None:
+        """Cancel those of `futures` that have not yet started"""
+        for future in futures:
+            future.cancel()
 
 
     def create_mup(self, mup: MirrorUsagePoint):
-        return self.transport.post("/mup", mup.to_xml(mode="create"))
+        return self.transport.post(self.MIRROR_USAGE_POINT_LIST_PATH, mup.to_xml(mode="create"))
 
 
     def create_mirror_meter_reading(self, mup_id: int, mirror_meter_reading: MirrorMeterReading):
-        return self.transport.post(f'/mup/{mup_id}', mirror_meter_reading.to_xml(mode="create"))
+        return self.transport.post(self.MIRROR_USAGE_POINT_PATH.format(mup_id=mup_id), mirror_meter_reading.to_xml(mode="create"))
 
@@ -1,13 +1,19 @@
-from pydantic import BaseModel as PydanticBaseModel, Field, validator
-from typing import List, Literal, Optional, Union
+from pydantic import BaseModel as PydanticBaseModel, Field, PrivateAttr, validator
+from pydantic.fields import SHAPE_SINGLETON
+from typing import Any, Dict, List, Literal, Optional, Tuple, Type, TypeVar
+from xml.sax.saxutils import escape, quoteattr
+import functools
 import enum
-import xmltodict
 
 from .constants import UomType
 
 
+# A subclass of `BaseModel`, for class methods that return an instance of their class
+ModelType = TypeVar('ModelType', bound='BaseModel')
+
+
 END_DEVICE_CREATE_TEMPLATE_KWARGS = {
-    'include': {'device_category', 'lfdi', 'sfdi'},
+    'include': frozenset({'device_category', 'lfdi', 'sfdi'}),
     'by_alias': True
 }
 
@@ -16,7 +22,7 @@ DER_CREATE_TEMPLATE = {
 }
 
 DER_CAPABILITY_CREATE_TEMPLATE = {
-    'include': {'modes_supported', 'rtg_max_w', 'type_'},
+    'include': frozenset({'modes_supported', 'rtg_max_w', 'type_'}),
     'by_alias': True
 }
 
@@ -24,6 +30,137 @@ DEVICE_INFORMATION_CREATE_TEMPLATE = {
     'include': {}
 }
 
+# Options for every `xmltodict.parse` call. Namespaces are not expanded (2030.5 documents
+# use a single default namespace), entity declarations are rejected, and plain `dict`s are
+# constructed rather than the `OrderedDict` default of older `xmltodict` releases, as 
+# element order is not needed to populate the models.
+XML_PARSE_KWARGS = {
+    'process_namespaces': False,
+    'disable_entities': True,
+    'dict_constructor': dict,
+}
+
+
+def parse_xml(document, **kwargs) -> dict:
+    """Parse an XML document into a dictionary. All XML parsing in this library should go 
+    through this function so that the options in `XML_PARSE_KWARGS` are applied consistently.
+
+    Note: `xmltodict` (>=0.12) always enables Expat `buffer_text`, so character data is
+    delivered in a single callback per element and does not need to be requested here.
+
+    Args:
+        document (str, bytes or file-like): XML document
+        **kwargs: Additional arguments passed to `xmltodict.parse`
+
+    Returns:
+        dict: dictionary representation of the document
+    """
+    # Imported when first needed, as most documents are generated (see `unparse_xml`)
+    # rather than parsed
+    import xmltodict
+    return xmltodict.parse(document, **{**XML_PARSE_KWARGS, **kwargs})
+
+
+def _emit_xml(key: str, value, parts: List[str]) -> None:
+    """Append the XML for element `key` with `value` to `parts`, following the same
+    conventions as `xmltodict.unparse` (lists are repeated elements, `@`-prefixed keys are
+    attributes and `#text` is character data).
+    """
+    if not hasattr(value, '__iter__') or isinstance(value, (str, dict)):
+        value = [value]
+    for v in value:
+        if v is None:
+            parts.append(f'<{key}></{key}>')
+            continue
+        if isinstance(v, bool):
+            v = 'true' if v else 'false'
+        elif not isinstance(v, dict):
+            v = str(v)
+        if isinstance(v, str):
+            parts.append(f'<{key}>{escape(v)}</{key}>')
+            continue
+        cdata = None
+        attrs = []
+        children = []
+        for child_key, child_value in v.items():
+            if child_key == '#text':
+                cdata = child_value
+            elif child_key.startswith('@'):
+                if child_key == '@xmlns' and isinstance(child_value, dict):
+                    attrs.extend(
+                        f' xmlns{":" + prefix if prefix else ""}={quoteattr(str(uri))}'
+                        for prefix, uri in child_value.items()
+                    )
+                else:
+                    attrs.append(f' {child_key[1:]}={quoteattr(str(child_value))}')
+            else:
+                children.append((child_key, child_value))
+        parts.append(f'<{key}{"".join(attrs)}>')
+        for child_key, child_value in children:
+            _emit_xml(child_key, child_value, parts)
+        if cdata is not None:
+            parts.append(escape(cdata))
+        parts.append(f'</{key}>')
+
+
+def unparse_xml(document: dict) -> str:
+    """Generate a (non-pretty) XML fragment from a dictionary. This produces the same
+    output as `xmltodict.unparse(document, full_document=False)`, but writes the
+    elements directly rather than through a SAX content handler.
+
+    Args:
+        document (dict): dictionary representation of the document
+
+    Returns:
+        str: XML document (as string)
+    """
+    parts = []
+    for key, value in document.items():
+        _emit_xml(key, value, parts)
+    return ''.join(parts)
+
+
+# `XmlTemplate` options that `_scalar_xml_fields` can resolve ahead of time
+SCALAR_XML_TEMPLATE_OPTIONS = frozenset({'include', 'exclude', 'by_alias'})
+
+
+@functools.lru_cache(maxsize=None)
+def _scalar_xml_fields(model_class: type, mode: str) -> Optional[Tuple[Tuple[str, str], ...]]:
+    """The `(name, element tag)` of the fields that `model_class` serialises with the `mode` 
+    template (in declaration order), if these are all scalar values, so that the generated 
+    XML depends only on their values (and whether they were set). Returns `None` if the XML 
+    may depend on nested models, on template options other than include/exclude/by_alias,
+    on a `dict()` override (e.g. adding `@xmlns`) or if any field is an XML attribute.
+    """
+    if model_class.dict is not BaseModel.dict:
+        return None
+    template = model_class._xml_templates.get(mode, {})
+    if not SCALAR_XML_TEMPLATE_OPTIONS.issuperset(template):
+        return None
+    include = template.get('include')
+    if include is None:
+        names = set(model_class.__fields__)
+    elif isinstance(include, (set, frozenset)) or include == {}:
+        names = set(include)
+    else:
+        return None
+    exclude = template.get('exclude')
+    if isinstance(exclude, (set, frozenset)):
+        names -= exclude
+    elif exclude is not None:
+        return None
+    by_alias = template.get('by_alias', False)
+    fields = []
+    for name, field in model_class.__fields__.items():
+        if name not in names:
+            continue
+        if (field.shape != SHAPE_SINGLETON or field.sub_fields or not isinstance(field.type_, type)
+                or issubclass(field.type_, PydanticBaseModel) or field.alias.startswith('@')):
+            return None
+        fields.append((name, field.alias if by_alias else name))
+    return tuple(fields)
+
+
 class BaseModel(PydanticBaseModel):
     """A sub-class of pydantic `BaseModel` that provides some convenience functions
     around the 
@@ -56,6 +193,20 @@ class BaseModel(PydanticBaseModel):
         link = {}
         show = {}
 
+    # Generated XML documents keyed by `(mode, pretty)`, along with the field values they
+    # were generated from (see `to_xml`)
+    _xml_cache: Dict[Tuple[str, bool], Tuple[tuple, str]] = PrivateAttr(default_factory=dict)
+
+    # `XmlTemplate` options keyed by mode, resolved once per class in `__init_subclass__`
+    _xml_templates = {}
+
+    def __init_subclass__(cls, **kwargs) -> None:
+        super().__init_subclass__(**kwargs)
+        cls._xml_templates = {
+            mode: template for mode, template in vars(cls.XmlTemplate).items() 
+            if not mode.startswith('_')
+        }
+
     def dict(self, exclude_unset=True, *args, **kwargs) -> dict:
         """Overrides the pydantic `BaseModel.dict` method to use the supplied templates
         when the `mode` is passed in.
@@ -64,8 +215,9 @@ class BaseModel(PydanticBaseModel):
             dict: dictionary representation of the object
         """
         if 'mode' in kwargs:
-            additional_kwargs = getattr(self.XmlTemplate, kwargs.pop('mode'), {})
-            return super().dict(exclude_unset=exclude_unset, *args, **{**kwargs, **additional_kwargs})
+            additional_kwargs = self._xml_templates.get(kwargs.pop('mode'), {})
+            # Template options take precedence over those supplied by the caller
+            return super().dict(*args, **{'exclude_unset': exclude_unset, **kwargs, **additional_kwargs})
         return super().dict(*args, **kwargs)
 
     def xml_dict(self, *args, **kwargs) -> dict:
@@ -82,17 +234,31 @@ class BaseModel(PydanticBaseModel):
         """
         return {self.__class__.__name__: self.dict(*args, **kwargs)}
 
+    @classmethod
+    def from_dict(cls: Type[ModelType], dct: Dict[str, Any]) -> ModelType:
+        """Create an instance of this class from an already parsed dictionary representation
+        of the XML element (e.g. an item streamed from a parent list), avoiding a
+        further XML parse.
+
+        Args:
+            dct (dict): dictionary representation of the XML element for this object
+
+        Returns:
+            BaseModel: Instance of this class.
+        """
+        return cls(**dct)
+
     @classmethod
     def from_xml(cls, document: str) -> 'BaseModel':
         """Parse an XML document to create an instance of this class
 
         Args:
-            document (str): XML document
+            document (str, bytes or file-like): XML document
 
         Returns:
             BaseModel: Instance of this class.
         """
-        return cls(**xmltodict.parse(document)[cls.__name__])
+        return cls.from_dict(parse_xml(document)[cls.__name__])
 
     def to_xml(self, mode='create', pretty=False) -> str:
         """Generate XML according to a particular template from this object 
@@ -105,7 +271,40 @@ class BaseModel(PydanticBaseModel):
         Returns:
             str: XML document (as string)
         """
-        return xmltodict.unparse(self.xml_dict(mode=mode), full_document=False, pretty=pretty)
+        # Where the template only includes scalar fields, the document is reused for as long
+        # as those fields are unchanged (e.g. when the same object is submitted repeatedly)
+        fields = _scalar_xml_fields(type(self), mode)
+        if fields is not None:
+            values = tuple(getattr(self, name) for name, _ in fields)
+            # Types are part of the key, as equal values (e.g. `True` and `1`) render differently
+            key = (
+                values,
+                tuple(type(value) for value in values),
+                tuple(name in self.__fields_set__ for name, _ in fields),
+            )
+            cached = self._xml_cache.get((mode, pretty))
+            if cached is not None and cached[0] == key:
+                return cached[1]
+
+        if fields is not None and not pretty:
+            # Write the (set) fields directly, rather than through `self.dict()`
+            tag = self.__class__.__name__
+            parts = [f'<{tag}>']
+            for (name, element_tag), value, is_set in zip(fields, values, key[2]):
+                if is_set:
+                    # `dict()` gives enum values (combined flags are otherwise iterated)
+                    _emit_xml(element_tag, value.value if isinstance(value, enum.Enum) else value, parts)
+            parts.append(f'</{tag}>')
+            document = ''.join(parts)
+        elif pretty:
+            import xmltodict
+            document = xmltodict.unparse(self.xml_dict(mode=mode), full_document=False, pretty=True)
+        else:
+            document = unparse_xml(self.xml_dict(mode=mode))
+
+        if fields is not None:
+            self._xml_cache[(mode, pretty)] = (key, document)
+        return document
 
 
 
@@ -157,30 +356,35 @@ class PydanticList(BaseModel):
         Returns:
             dict: Object dictionary representation
         """
-        include, exclude = None, None
-        if 'include' in kwargs:
-            include = kwargs['include']
-            if isinstance(include, set):
-                kwargs['include'] = None
-        if 'exclude' in kwargs:
-            print(kwargs['exclude'])
-            print(self.list_field)
-            exclude = kwargs['exclude']
-            if isinstance(exclude, set) and self.list_field in exclude:
-                return []
-            elif isinstance(exclude, dict):
-                kwargs['exclude'] = exclude.get(self.list_field)
-            else:
-                kwargs['exclude'] = None
-
-
+        if self._exclude_list_items(kwargs):
+            return []
         return {self.__class__.__name__: 
-            {
-                (self.__fields__[self.list_field].alias or self.list_field): 
-                [sub.dict(*args, **kwargs) for sub in getattr(self, self.list_field)]
-            }
+            {self._list_alias: [sub.dict(*args, **kwargs) for sub in getattr(self, self.list_field)]}
         }
 
+    def __init_subclass__(cls, **kwargs) -> None:
+        super().__init_subclass__(**kwargs)
+        # Element name of the list items, resolved once per class
+        list_field = cls.__fields__['list_field'].default
+        if list_field in cls.__fields__:
+            cls._list_alias = cls.__fields__[list_field].alias or list_field
+
+    def _exclude_list_items(self, kwargs: dict) -> bool:
+        """Convert the `include`/`exclude` options in `kwargs` (in place) to those that
+        apply to each item of the list.
+
+        Returns:
+            bool: Whether the list field itself is excluded
+        """
+        if isinstance(kwargs.get('include'), (set, frozenset)):
+            kwargs['include'] = None
+        exclude = kwargs.get('exclude')
+        if exclude is not None:
+            if isinstance(exclude, (set, frozenset)) and self.list_field in exclude:
+                return True
+            kwargs['exclude'] = exclude.get(self.list_field) if isinstance(exclude, dict) else None
+        return False
+
     def xml_dict(self, *args, **kwargs) -> dict:
         """Generate a dictionary corresponding to the structure of an XML document.
         Identical to `self.dict(*args, **kwargs)`
@@ -190,6 +394,25 @@ class PydanticList(BaseModel):
         """
         return self.dict(*args, **kwargs)
 
+    def to_xml(self, mode='create', pretty=False) -> str:
+        """Generate XML according to a particular template from this list. Where each item
+        element is named after the item class, the items' own (possibly cached) XML is 
+        concatenated, rather than building a dictionary of the whole list.
+
+        Args:
+            mode (str, optional): Template to use for creating XML document. Defaults to 'create'.
+            pretty (bool, optional): Include whitespace in resulting XML that preserves structure. Defaults to False.
+
+        Returns:
+            str: XML document (as string)
+        """
+        if not pretty:
+            items = getattr(self, self.list_field)
+            if all(type(item).__name__ == self._list_alias for item in items):
+                tag = self.__class__.__name__
+                return f'<{tag}>{"".join(item.to_xml(mode=mode) for item in items)}</{tag}>'
+        return super().to_xml(mode=mode, pretty=pretty)
+
 
 
 """ Abstract
@@ -290,8 +513,31 @@ class DateTimeIntervalType(BaseModel):
 
 
 
-class DeviceCategoryType(enum.IntEnum):
-    """The Device category types defined."""
+class BitmapType(enum.IntFlag):
+    """Base class for 2030.5 bitmap types, whose members may be combined with `|`.
+    """
+
+    @classmethod
+    def __get_validators__(cls):
+        yield cls.validate
+
+    @classmethod
+    def validate(cls, value):
+        if type(value) is cls:
+            return value
+        # Parsed XML provides strings, and `IntFlag` does not coerce them itself
+        value = int(value)
+        # Look up single members directly, only building composite flags when needed
+        member = cls._value2member_map_.get(value)
+        if member is None:
+            member = cls(value)
+        return member
+
+
+class DeviceCategoryType(BitmapType):
+    """The Device category types defined. Categories are bit flags, so a device may
+    belong to several categories (e.g. `electric_vehicle | other_storage_system`).
+    """
     electric_vehicle = 65536
     virtual_or_mixed_der = 262144
     reciprocating_engine = 524288
@@ -301,11 +547,9 @@ class DeviceCategoryType(enum.IntEnum):
     other_storage_system = 33554432
 
 
-class FunctionsImplementedType(enum.IntEnum):
+class FunctionsImplementedType(BitmapType):
     """Bitmap indicating the function sets used by the device as a client.
     """
-    # TODO This should be implemented as flags, as they can support compositions of
-    # these properties
     device_capability = 0
     selfdevice_resource = 1
     enddevice_resource = 2
@@ -351,7 +595,7 @@ class ValueWithMultiplier(BaseModel):
 
     class XmlTemplate:
         create = {
-            'include': {'multiplier', 'value'},
+            'include': frozenset({'multiplier', 'value'}),
             'by_alias': True,
             'exclude_unset': False
         }
@@ -484,7 +728,7 @@ class ConnectionPoint(BaseModel):
 
     class XmlTemplate:
         create = {
-            'include': {'connection_point_id', 'meter_id'},
+            'include': frozenset({'connection_point_id', 'meter_id'}),
             'by_alias': True
         }
         show = create
@@ -513,44 +757,51 @@ class EndDevice(BaseModel):
 
     class XmlTemplate:
         create = {
-            'include': {'device_category', 'lfdi', 'sfdi', 'changed_time', 'post_rate', 'enabled'},
+            'include': frozenset({'device_category', 'lfdi', 'sfdi', 'changed_time', 'post_rate', 'enabled'}),
             'by_alias': True,
         }
         link = {
-            'include': {'device_category', 'lfdi', 'sfdi', 'der_list_link', 'DeviceInformationLink'},
+            'include': frozenset({'device_category', 'lfdi', 'sfdi', 'der_list_link', 'DeviceInformationLink'}),
             'by_alias': True,
         }
         show = {
-            'include': {'device_category', 'lfdi', 'sfdi', 'der', 'device_information'},
+            'include': frozenset({'device_category', 'lfdi', 'sfdi', 'der', 'device_information'}),
             'by_alias': True,
         }
 
     @validator('sfdi', always=True)
     def calculate_sfdi(cls, v, values):
+        if v:
+            # supplied (e.g. by the server), so the lFDI need not be parsed
+            return v
         lfdi = int(values.get('lfdi'), 16)
-        print(lfdi)
-        if lfdi and not v:
+        if lfdi:
             bit_left_truncation_len = 36
-            # truncate the lFDI
-            sfdi_no_sod_checksum = lfdi>>(lfdi.bit_length()-bit_left_truncation_len)
-            # calculate sum-of-digits checksum digit
-            sod_checksum = 10 - sum([int(digit) for digit in str(sfdi_no_sod_checksum)]) % 10
+            # truncate the lFDI (an lFDI shorter than the truncation length is used as is)
+            sfdi_no_sod_checksum = lfdi >> max(lfdi.bit_length() - bit_left_truncation_len, 0)
+            # calculate sum-of-digits checksum digit, such that the sum of all digits
+            # (including the checksum) is a multiple of 10
+            digit_sum = 0
+            remaining = sfdi_no_sod_checksum
+            while remaining:
+                remaining, digit = divmod(remaining, 10)
+                digit_sum += digit
+            sod_checksum = (10 - digit_sum % 10) % 10
             # right concatenate the checksum digit and return
-            return str(sfdi_no_sod_checksum) + str(sod_checksum)
+            return f'{sfdi_no_sod_checksum}{sod_checksum}'
         return v
 
 
 class EndDeviceList(PydanticList):
     """A List element to hold `EndDevice` objects.
     """
-    # Can't tell the difference between single item and list in XML, so need to cater to 
-    # single item entry
-    end_device: Union[List[EndDevice], EndDevice] = Field(alias='EndDevice')
+    end_device: List[EndDevice] = Field(alias='EndDevice')
     list_field: Literal["end_device"] = "end_device"
 
-    @validator('end_device')
+    @validator('end_device', pre=True)
     def ensure_list(cls, v):
-        print(v)
+        # Can't tell the difference between single item and list in XML, so need to cater
+        # to single item entry before the items are validated
         if not isinstance(v, list):
             return [v]
         return v
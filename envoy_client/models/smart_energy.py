@@ -2,26 +2,6 @@
 from .constants import *
 from .base import *
 from typing import Optional
-import enum
-
-class RoleFlagsType(enum.Flag):
-    IsMirror = 0
-    IsPremiseAggregationPoint = 1
-    IsPEV = 2
-    IsDER = 4
-    IsRevenueQuality = 8
-    IsDC = 16
-    IsSubmeter = 32
-
-
-class ServiceKind(enum.IntEnum):
-    Electricity = 0
-    Gas = 1
-    Water = 2
-    Time = 3
-    Pressure = 4
-    Heat = 5
-    Cooling = 6
 
 
 class MirrorUsagePoint(BaseModel):
@@ -94,6 +74,13 @@ class MirrorMeterReading(IdentifiedObject):
     last_update_time: Optional[TimeType] = Field(alias="lastUpdateTime")
     next_update_time: Optional[TimeType] = Field(alias="nextUpdateTime")
     reading_type: Optional[ReadingType] = Field(alias="ReadingType")
-    mirror_reading_set: Union[List[MirrorReadingSet], MirrorReadingSet, None] = Field(alias="MirrorReadingSet")
+    mirror_reading_set: Optional[List[MirrorReadingSet]] = Field(alias="MirrorReadingSet")
     reading: Optional[Reading] = Field(alias="Reading")
+
+    @validator('mirror_reading_set', pre=True)
+    def ensure_list(cls, v):
+        # A single `MirrorReadingSet` element can't be distinguished from a list in XML
+        if v is not None and not isinstance(v, list):
+            return [v]
+        return v
  
\ No newline at end of file
@@ -1,6 +1,9 @@
 
-from envoy_client.models import DeviceCategoryType, EndDevice, EndDeviceList
+from envoy_client.models import DeviceCategoryType, EndDevice, EndDeviceList, parse_xml
+import io
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from urllib.parse import urljoin
 from typing import Optional
 import xmltodict
@@ -13,11 +16,28 @@ class Transport:
     """Abstract base class that represents the transport medium used to 
     communicate with the utility server.
     """
+    # Media type of request and response documents. The models currently only support
+    # the XML encoding, but transports may negotiate another representation here.
+    content_type = 'application/xml'
+
     def __init__(self, base_url: str, auth: Optional[Auth]) -> None:
         self.base_url = base_url
         self.auth = auth
         self.is_connected = False
         self.session = None
+        # `(base_url, origin)` of the last resolved base URL (see `_url`)
+        self._origin = (None, None)
+
+    def _url(self, path: str) -> str:
+        """Resolve `path` against the base URL, as `urljoin(self.base_url, path)` does. 
+        Server paths are absolute (e.g. `/edev/1`), so these are appended to the (cached) 
+        origin of the base URL without re-parsing it on every request.
+        """
+        if path.startswith('/') and not path.startswith('//') and '/.' not in path:
+            if self._origin[0] != self.base_url:
+                self._origin = (self.base_url, urljoin(self.base_url, '/')[:-1])
+            return self._origin[1] + path
+        return urljoin(self.base_url, path)
 
     def post(self, path: str, document: str) -> requests.Response:
         """Send a POST request to the utility server
@@ -32,9 +52,16 @@ class Transport:
         raise NotImplementedError
 
     
-    def get(self, path: str) -> requests.Response:
+    def get(self, path: str, stream: bool = False, headers: Optional[dict] = None) -> requests.Response:
         """Send a GET request to the utility server
 
+        Args:
+            path (str): resource path (excluding base URL)
+            stream (bool, optional): Defer reading the response body, so that it can be
+                consumed incrementally from `response.raw`. Defaults to False.
+            headers (dict, optional): Additional headers for this request only (e.g. 
+                conditional request headers). Defaults to None.
+
         Returns:
             requests.Response: server response
         """
@@ -71,60 +98,113 @@ class Transport:
 
 
 class RequestsTransport(Transport):
-    """`Transport` that uses the python `requests` library
+    """`Transport` that uses the python `requests` library. A single `Session` is 
+    created on `connect` and reused for every request, so that the underlying 
+    TCP/TLS connections are pooled rather than re-established per request.
     """
+    # Transient gateway/server errors that idempotent requests are retried on
+    RETRY_STATUSES = (502, 503, 504)
+
+    def __init__(self, base_url: str, auth: Optional[Auth], pool_connections: int = 1, pool_maxsize: int = 32, 
+                 max_retries: int = 3) -> None:
+        """
+        Args:
+            base_url (str): URL of the utility server
+            auth (Auth, optional): Authorisation applied to the session
+            pool_connections (int, optional): Number of host connection pools to cache. Defaults to 1.
+            pool_maxsize (int, optional): Maximum number of connections kept open per host. 
+                Should be at least the number of threads sharing the transport. Defaults to 32.
+            max_retries (int, optional): Number of times a failed connection (or a response
+                with one of `RETRY_STATUSES`) is retried, with backoff, for idempotent requests. 
+                Defaults to 3.
+        """
+        super().__init__(base_url, auth)
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.max_retries = max_retries
+
     def connect(self):
         if self.is_connected:
             logger.info(f"{self.__class__} is already connected")
+            return
         self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=self.pool_connections, 
+            pool_maxsize=self.pool_maxsize,
+            # The last response is returned (rather than raising) once retries are exhausted
+            max_retries=Retry(
+                total=self.max_retries, 
+                backoff_factor=0.2, 
+                status_forcelist=self.RETRY_STATUSES,
+                raise_on_status=False,
+            ),
+        )
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
         if self.auth:
             self.auth.update_session(self.session)
-        self.session.headers["Content-Type"] = 'application/xml'
+        self.session.headers["Content-Type"] = self.content_type
         self.is_connected = True
         
     def close(self):
-        self.session.close()
+        if self.session is not None:
+            self.session.close()
+        self.session = None
+        self.is_connected = False
 
-    def get(self, path: str) -> requests.Response:
-        response = self.session.get(urljoin(self.base_url, path))
+    def get(self, path: str, stream: bool = False, headers: Optional[dict] = None) -> requests.Response:
+        response = self.session.get(self._url(path), stream=stream, headers=headers)
         self._log_response(response)
         return response
 
     def post(self, path: str, document: str) -> requests.Response:
-        response = self.session.post(urljoin(self.base_url, path), data=document)
+        response = self.session.post(self._url(path), data=document)
         self._log_response(response)
         return response
 
     def put(self, path: str, document: str) -> requests.Response:
-        response = self.session.put(urljoin(self.base_url, path), document)
+        response = self.session.put(self._url(path), document)
         self._log_response(response)
         return response
 
     def _log_response(self, response) -> None:
         if response.status_code > 201:
-            logger.warning(f'{response.request.method} {response.request.url} returned status {response.status_code}')
+            logger.warning('%s %s returned status %d', response.request.method, response.request.url, response.status_code)
         else:
-            logger.info(f'{response.request.method} {response.request.url} returned status {response.status_code}')
+            logger.info('%s %s returned status %d', response.request.method, response.request.url, response.status_code)
 
 
 class MockResponse:
     """A mock response object used by the `MockTransport` to provide a response 
     from which resource locations can be extracted
     """
+    __slots__ = ('status_code', 'content', 'request', 'raw', 'headers')
+
     def __init__(self, request, status_code=201, content='', location=None) -> None:
         self.status_code = status_code
         self.content = content
         self.request = request
+        self.raw = io.BytesIO(content.encode() if isinstance(content, str) else content)
 
         self.headers = {}
         if self.request.method in ('PUT', 'POST'):
             self.headers['location'] = location or '/mock/location/1'
 
+    def __bool__(self) -> bool:
+        return self.status_code < 400
+
+    def close(self) -> None:
+        self.raw.close()
+
 
 class MockTransport(RequestsTransport):
     """A mock `Transport` object that prints the details of requests and returns a `MockResponse`.
     Useful for generating documentation about client-server interactions.
     """
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        # Generated response documents, keyed by path
+        self._content_cache = {}
 
     def generate_random_content(self, path):
         # This is required to have a functional mock_sync_devices method
@@ -139,12 +219,12 @@ class MockTransport(RequestsTransport):
         else:
             raise ValueError(f'`MockTransport` does not support returning mock data on path {path}')
     
-    def get(self, path: str) -> MockResponse:
+    def get(self, path: str, stream: bool = False, headers: Optional[dict] = None) -> MockResponse:
         request = requests.Request(
             'GET', 
-            urljoin(self.base_url, path),
+            self._url(path),
+            headers=headers,
         )
-        prepared = request.prepare()
         header_str = '\n'.join(f"{k}: {v}" for k, v in request.headers.items())
 
 
@@ -152,38 +232,39 @@ class MockTransport(RequestsTransport):
     {request.method} {request.url}
     {header_str}
         """)
-        return MockResponse(request, 200, content=self.generate_random_content(path).to_xml(mode='show'))
+        content = self._content_cache.get(path)
+        if content is None:
+            content = self._content_cache[path] = self.generate_random_content(path).to_xml(mode='show')
+        return MockResponse(request, 200, content=content)
 
     def post(self, path: str, document: str) -> MockResponse:
         request = requests.Request(
             'POST', 
-            urljoin(self.base_url, path),
-            headers={'Content-Type': 'application/xml'},
+            self._url(path),
+            headers={'Content-Type': self.content_type},
             data=document
         )
-        prepared = request.prepare()
         header_str = '\n'.join(f"{k}: {v}" for k, v in request.headers.items())
         print(f"""
 {request.method} {request.url}
 {header_str}
 
-{xmltodict.unparse(xmltodict.parse(document), pretty=True)}
+{xmltodict.unparse(parse_xml(document), pretty=True)}
         """, )
         return MockResponse(request)
 
     def put(self, path: str, document: str) -> MockResponse:
         request = requests.Request(
             'PUT', 
-            urljoin(self.base_url, path),
-            headers={'Content-Type': 'application/xml'},
+            self._url(path),
+            headers={'Content-Type': self.content_type},
             data=document
         )
-        prepared = request.prepare()
         header_str = '\n'.join(f"{k}: {v}" for k, v in request.headers.items())
         print(f"""
 {request.method} {request.url}
 {header_str}
 
-{xmltodict.unparse(xmltodict.parse(document), pretty=True)}
+{xmltodict.unparse(parse_xml(document), pretty=True)}
         """, )
         return MockResponse(request, 200)
@@ -8,7 +8,7 @@ with open("README.md", "r") as fh:
 install_requires = [
     'requests>=2.20',
     'xmltodict>=0.12',
-    'pydantic>=1.8'
+    'pydantic>=1.8,<2'
 ]
 
 
@@ -1,7 +1,9 @@
 
 import xmltodict
 
-from envoy_client.models import EndDevice, EndDeviceList, DeviceCategoryType
+from envoy_client.models import ConnectionPoint, EndDevice, EndDeviceList, DeviceCategoryType, \
+    LinkType, ListLinkType, PollRateType
+from envoy_client.models.smart_energy import MirrorMeterReading
 
 import random
 
@@ -21,4 +23,114 @@ def test_end_device_serialisation_deserialisation():
     xml = xmltodict.unparse(end_device.xml_dict(by_alias=True), full_document=False)
     rehydrated_end_device = EndDevice(**xmltodict.parse(xml)['EndDevice'])
 
-    print(rehydrated_end_device)
\ No newline at end of file
+    print(rehydrated_end_device)
+
+def test_end_device_to_xml_matches_xmltodict():
+    end_device = EndDevice(
+        lfdi=random_lfdi(),
+        device_category=DeviceCategoryType.electric_vehicle,
+        connection_point=ConnectionPoint(meter_id='NMI<&>123'),
+    )
+
+    for mode in ('create', 'link', 'show'):
+        expected = xmltodict.unparse(end_device.xml_dict(mode=mode), full_document=False)
+        assert end_device.to_xml(mode=mode) == expected
+
+
+def test_end_device_to_xml_reflects_changes_after_caching():
+    end_device = EndDevice(
+        lfdi=random_lfdi(),
+        device_category=DeviceCategoryType.electric_vehicle
+    )
+    assert end_device.to_xml(mode='create') is end_device.to_xml(mode='create')
+
+    end_device.enabled = False
+    assert '<enabled>false</enabled>' in end_device.to_xml(mode='create')
+
+
+def test_end_device_to_xml_reflects_equal_values_of_different_type():
+    end_device = EndDevice(
+        lfdi=random_lfdi(),
+        device_category=DeviceCategoryType.electric_vehicle,
+        enabled=True,
+    )
+    assert '<enabled>true</enabled>' in end_device.to_xml()
+
+    end_device.enabled = 1
+    assert end_device.to_xml() == end_device.copy().to_xml()
+    assert '<enabled>1</enabled>' in end_device.to_xml()
+
+
+def test_end_device_sfdi_checksum():
+    end_device = EndDevice(lfdi='0x21352135135', device_category=DeviceCategoryType.electric_vehicle)
+    assert end_device.sfdi == '356563223726'
+
+    for _ in range(100):
+        end_device = EndDevice(lfdi=random_lfdi(), device_category=DeviceCategoryType.electric_vehicle)
+        assert sum(int(digit) for digit in end_device.sfdi) % 10 == 0
+
+
+def test_end_device_combined_device_category_round_trip():
+    device_category = DeviceCategoryType.electric_vehicle | DeviceCategoryType.other_storage_system
+    end_device = EndDevice(lfdi=random_lfdi(), device_category=device_category)
+
+    rehydrated_end_device = EndDevice.from_xml(end_device.to_xml())
+
+    assert rehydrated_end_device.device_category == device_category
+    assert DeviceCategoryType.electric_vehicle in rehydrated_end_device.device_category
+
+
+def test_end_device_list_to_xml_matches_xmltodict():
+    end_device_list = EndDeviceList(end_device=[
+        EndDevice(lfdi=random_lfdi(), device_category=DeviceCategoryType.electric_vehicle)
+        for _ in range(3)
+    ])
+
+    expected = xmltodict.unparse(end_device_list.xml_dict(mode='create'), full_document=False)
+    assert end_device_list.to_xml() == expected
+
+
+def test_end_device_list_from_xml_with_single_end_device():
+    end_device = EndDevice(lfdi=random_lfdi(), device_category=DeviceCategoryType.electric_vehicle)
+
+    end_device_list = EndDeviceList.from_xml(EndDeviceList(end_device=[end_device]).to_xml())
+
+    assert [item.lfdi for item in end_device_list.end_device] == [end_device.lfdi]
+
+
+def test_end_device_sfdi_for_short_lfdi():
+    end_device = EndDevice(lfdi='0x1', device_category=DeviceCategoryType.electric_vehicle)
+
+    assert end_device.sfdi == '19'
+
+
+def test_end_device_keeps_supplied_sfdi():
+    end_device = EndDevice(lfdi=random_lfdi(), sfdi='123', device_category=DeviceCategoryType.electric_vehicle)
+
+    assert end_device.sfdi == '123'
+
+
+def test_attribute_models_to_xml_matches_xmltodict():
+    for model in (LinkType(href='/edev/1'), ListLinkType(href='/edev', all_='3'), PollRateType(pollRate=900)):
+        expected = xmltodict.unparse(model.xml_dict(mode='create'), full_document=False)
+        assert model.to_xml() == expected
+
+
+def mirror_reading_set_xml(mrid):
+    return (
+        f'<MirrorReadingSet><mRID>{mrid}</mRID>'
+        '<timePeriod><duration>300</duration><start>1600000000</start></timePeriod>'
+        '<Reading><value>1</value></Reading><Reading><value>2</value></Reading>'
+        '</MirrorReadingSet>'
+    )
+
+
+def test_mirror_meter_reading_reading_sets_are_a_list():
+    for count in (1, 3):
+        reading_sets = ''.join(mirror_reading_set_xml(mrid) for mrid in range(count))
+        mirror_meter_reading = MirrorMeterReading.from_xml(
+            f'<MirrorMeterReading><mRID>10</mRID>{reading_sets}</MirrorMeterReading>'
+        )
+
+        assert isinstance(mirror_meter_reading.mirror_reading_set, list)
+        assert [reading_set.mrid for reading_set in mirror_meter_reading.mirror_reading_set] == list(range(count))
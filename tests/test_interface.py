@@ -0,0 +1,288 @@
+import time
+
+import pytest
+import requests
+
+from envoy_client.interface import EndDeviceInterface
+from envoy_client.models import DeviceCategoryType, EndDevice, EndDeviceList
+from envoy_client.transport import MockResponse, MockTransport
+
+
+END_DEVICE = EndDevice(lfdi='0x3497623952', device_category=DeviceCategoryType.electric_vehicle)
+
+
+def make_end_devices(count):
+    """`count` electric vehicle `EndDevice`s with consecutive LFDIs, starting from `END_DEVICE`"""
+    return [
+        EndDevice(lfdi=hex(0x3497623952 + i), device_category=DeviceCategoryType.electric_vehicle)
+        for i in range(count)
+    ]
+
+
+def make_client(transport):
+    """An `EndDeviceInterface` using `transport`, whose aggregator LFDI is not among the 
+    `EndDevice`s from `make_end_devices`
+    """
+    return EndDeviceInterface(transport, lfdi='0x21352135135')
+
+
+class RecordingTransport(MockTransport):
+    """A `MockTransport` that records requests and returns a fixed `EndDevice` with an ETag,
+    responding with `304` when the ETag is supplied
+    """
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.requests = []
+
+    def get(self, path, stream=False, headers=None):
+        request = requests.Request('GET', path, headers=headers)
+        self.requests.append(request)
+        if headers and headers.get('If-None-Match') == '"v1"':
+            return MockResponse(request, 304)
+        response = MockResponse(request, 200, content=END_DEVICE.to_xml(mode='create'))
+        response.headers['ETag'] = '"v1"'
+        return response
+
+
+def test_get_end_device_revalidates_with_etag():
+    client = make_client(RecordingTransport('https://server-location', auth=None))
+
+    first = client.get_end_device(3, revalidate=True)
+    second = client.get_end_device(3, revalidate=True)
+
+    assert second == first
+    assert second.lfdi == END_DEVICE.lfdi
+    assert client.transport.requests[1].headers['If-None-Match'] == '"v1"'
+
+
+def test_get_end_device_does_not_cache_by_default():
+    client = make_client(RecordingTransport('https://server-location', auth=None))
+
+    client.get_end_device(3)
+    client.get_end_device(3)
+
+    assert 'If-None-Match' not in client.transport.requests[1].headers
+    assert not client._response_cache
+
+
+def test_get_end_device_does_not_share_cached_end_device():
+    client = make_client(RecordingTransport('https://server-location', auth=None))
+
+    first = client.get_end_device(3, revalidate=True)
+    first.enabled = False
+    second = client.get_end_device(3, revalidate=True)
+    second.post_rate = 60
+    third = client.get_end_device(3, revalidate=True)
+
+    assert client.transport.requests[2].headers['If-None-Match'] == '"v1"'
+    assert third.enabled is True
+    assert third.post_rate == END_DEVICE.post_rate
+
+
+class PagedTransport(MockTransport):
+    """A `MockTransport` serving a fixed list of `EndDevice`s according to the `s` and `l`
+    query parameters
+    """
+    def __init__(self, end_devices, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.end_devices = end_devices
+        self.paths = []
+
+    def get(self, path, stream=False, headers=None):
+        self.paths.append(path)
+        query = dict(param.split('=') for param in path.partition('?')[2].split('&'))
+        start, limit = int(query['s']), int(query['l'])
+        content = EndDeviceList(end_device=self.end_devices[start:start + limit]).to_xml(mode='create')
+        return MockResponse(requests.Request('GET', path), 200, content=content)
+
+
+def test_get_paged_end_devices_requests_pages_lazily():
+    end_devices = make_end_devices(5)
+    transport = PagedTransport(end_devices, 'https://server-location', auth=None)
+    client = make_client(transport)
+
+    paged_end_devices = client.get_paged_end_devices(page_size=2, prefetch=False)
+    assert next(paged_end_devices).lfdi == end_devices[0].lfdi
+    assert transport.paths == ['/edev?s=0&l=2']
+
+    assert [end_device.lfdi for end_device in paged_end_devices] == [end_device.lfdi for end_device in end_devices[1:]]
+    assert transport.paths == ['/edev?s=0&l=2', '/edev?s=2&l=2', '/edev?s=4&l=2']
+
+
+class CappedPagedTransport(PagedTransport):
+    """A `PagedTransport` that returns at most `cap` `EndDevice`s per page, reporting the
+    total number of `EndDevice`s in the `all` attribute
+    """
+    def __init__(self, cap, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.cap = cap
+
+    def get(self, path, stream=False, headers=None):
+        self.paths.append(path)
+        query = dict(param.split('=') for param in path.partition('?')[2].split('&'))
+        start, limit = int(query['s']), min(int(query['l']), self.cap)
+        content = EndDeviceList(end_device=self.end_devices[start:start + limit]).to_xml(mode='create')
+        content = content.replace('<EndDeviceList>', f'<EndDeviceList all="{len(self.end_devices)}">', 1)
+        return MockResponse(requests.Request('GET', path), 200, content=content)
+
+
+def test_get_paged_end_devices_continues_after_short_page():
+    end_devices = make_end_devices(10)
+    transport = CappedPagedTransport(3, end_devices, 'https://server-location', auth=None)
+    client = make_client(transport)
+
+    paged_end_devices = list(client.get_paged_end_devices(page_size=5))
+
+    assert [end_device.lfdi for end_device in paged_end_devices] == [end_device.lfdi for end_device in end_devices]
+
+
+def test_get_paged_end_devices_stops_at_max_end_devices():
+    end_devices = make_end_devices(5)
+    transport = PagedTransport(end_devices, 'https://server-location', auth=None)
+    client = make_client(transport)
+
+    paged_end_devices = list(client.get_paged_end_devices(page_size=2, max_end_devices=2))
+
+    assert [end_device.lfdi for end_device in paged_end_devices] == [end_device.lfdi for end_device in end_devices[:2]]
+    assert transport.paths == ['/edev?s=0&l=2']
+
+
+class ETagPagedTransport(PagedTransport):
+    """A `PagedTransport` that tags each page with an ETag, responding with `304` when the 
+    ETag is supplied
+    """
+    def get(self, path, stream=False, headers=None):
+        if headers and headers.get('If-None-Match') == f'"{path}"':
+            self.paths.append(path)
+            return MockResponse(requests.Request('GET', path), 304)
+        response = super().get(path, stream=stream, headers=headers)
+        response.headers['ETag'] = f'"{path}"'
+        return response
+
+
+def test_get_paged_end_devices_reuses_unmodified_pages():
+    end_devices = make_end_devices(3)
+    transport = ETagPagedTransport(end_devices, 'https://server-location', auth=None)
+    client = make_client(transport)
+
+    first = list(client.get_paged_end_devices(page_size=2, revalidate=True))
+    second = list(client.get_paged_end_devices(page_size=2, revalidate=True))
+
+    assert [end_device.lfdi for end_device in second] == [end_device.lfdi for end_device in first]
+    assert second == first
+    assert second[0] is not first[0]
+
+
+def test_get_paged_end_devices_does_not_cache_pages_by_default():
+    end_devices = make_end_devices(3)
+    transport = ETagPagedTransport(end_devices, 'https://server-location', auth=None)
+    client = make_client(transport)
+
+    first = list(client.get_paged_end_devices(page_size=2))
+    second = list(client.get_paged_end_devices(page_size=2))
+
+    assert [end_device.lfdi for end_device in second] == [end_device.lfdi for end_device in first]
+    assert second[0] is not first[0]
+    assert not client._response_cache
+
+
+def test_update_end_device_invalidates_cached_end_device():
+    client = make_client(RecordingTransport('https://server-location', auth=None))
+
+    client.get_end_device(3, revalidate=True)
+    client.update_end_device(END_DEVICE, edev_id=3)
+    client.get_end_device(3, revalidate=True)
+
+    assert 'If-None-Match' not in client.transport.requests[1].headers
+
+
+def test_write_invalidates_end_device_read_during_write():
+    client = make_client(RecordingTransport('https://server-location', auth=None))
+    put = client.transport.put
+
+    def put_while_reading(*args, **kwargs):
+        # A concurrent read that completes before the write returns
+        client.get_end_device(3, revalidate=True)
+        return put(*args, **kwargs)
+
+    client.transport.put = put_while_reading
+    client.update_end_device(END_DEVICE, edev_id=3)
+    client.get_end_device(3, revalidate=True)
+
+    assert 'If-None-Match' not in client.transport.requests[1].headers
+
+
+def test_get_paged_end_devices_prefetches_next_page():
+    end_devices = make_end_devices(5)
+    transport = PagedTransport(end_devices, 'https://server-location', auth=None)
+    client = make_client(transport)
+
+    paged_end_devices = client.get_paged_end_devices(page_size=2)
+    assert next(paged_end_devices).lfdi == end_devices[0].lfdi
+    # At most one page is requested ahead of the page being consumed
+    assert transport.paths[0] == '/edev?s=0&l=2'
+    assert len(transport.paths) <= 2
+
+    assert len(list(paged_end_devices)) == 4
+    assert transport.paths == ['/edev?s=0&l=2', '/edev?s=2&l=2', '/edev?s=4&l=2']
+
+
+def test_sync_end_device_only_retrieves_end_device_when_verifying():
+    client = make_client(RecordingTransport('https://server-location', auth=None))
+
+    client.sync_end_device(END_DEVICE)
+    assert client.transport.requests == []
+
+    with_verify = make_client(RecordingTransport('https://server-location', auth=None))
+    with_verify.sync_end_device(END_DEVICE, verify=True)
+    assert [request.url for request in with_verify.transport.requests] == ['/edev/1']
+
+
+class FailingTransport(MockTransport):
+    """A `MockTransport` whose first POST fails (by raising `error`, or otherwise with a 
+    `500` response), recording the path and document of each POST
+    """
+    def __init__(self, *args, error=None, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.error = error
+        self.paths = []
+        self.documents = []
+
+    def post(self, path, document):
+        self.paths.append(path)
+        self.documents.append(document)
+        request = requests.Request('POST', path)
+        if len(self.paths) == 1:
+            if self.error:
+                raise self.error
+            return MockResponse(request, 500)
+        # Give the caller time to abort before any further requests are started
+        time.sleep(0.05)
+        return MockResponse(request)
+
+
+def test_sync_end_devices_aborts_after_error_response():
+    transport = FailingTransport('https://server-location', auth=None)
+    client = make_client(transport)
+    end_devices = make_end_devices(20)
+
+    responses = client.sync_end_devices(end_devices, max_workers=1)
+
+    assert len(responses) == len(end_devices)
+    assert responses[0].status_code == 500
+    # Only the failed request, and the one already in flight when it failed, are submitted
+    submitted = [EndDevice.from_xml(document).lfdi for document in transport.documents]
+    assert 1 <= len(submitted) <= 2
+    assert submitted == [end_device.lfdi for end_device in end_devices[:len(submitted)]]
+    assert all(response is not None for response in responses[:len(submitted)])
+    assert all(response is None for response in responses[len(submitted):])
+
+
+def test_sync_end_devices_aborts_after_request_exception():
+    transport = FailingTransport('https://server-location', auth=None, error=requests.ConnectionError())
+    client = make_client(transport)
+    end_devices = make_end_devices(20)
+
+    with pytest.raises(requests.ConnectionError):
+        client.sync_end_devices(end_devices, max_workers=1)
+    assert len(transport.paths) <= 2
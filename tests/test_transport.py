@@ -0,0 +1,54 @@
+from urllib.parse import urljoin
+import gzip
+import io
+
+import requests
+import urllib3
+
+from envoy_client.auth import LocalModeXTokenAuth
+from envoy_client.interface import EndDeviceInterface
+from envoy_client.models import DeviceCategoryType, EndDevice, EndDeviceList
+from envoy_client.transport import MockTransport, RequestsTransport
+
+
+def test_requests_transport_reuses_session():
+    transport = RequestsTransport('https://server-location', auth=LocalModeXTokenAuth('0x21352135135'))
+    transport.connect()
+    session = transport.session
+    transport.connect()
+
+    assert transport.session is session
+    assert session.headers['X-Token'] == str(0x21352135135)
+    assert session.get_adapter('https://server-location')._pool_maxsize == transport.pool_maxsize
+    assert 503 in session.get_adapter('https://server-location').max_retries.status_forcelist
+
+    transport.close()
+    assert not transport.is_connected
+
+
+def test_gzip_encoded_end_device_list_is_decoded():
+    end_devices = [
+        EndDevice(lfdi=hex(0x3497623952 + i), device_category=DeviceCategoryType.electric_vehicle)
+        for i in range(3)
+    ]
+    content = gzip.compress(EndDeviceList(end_device=end_devices).to_xml().encode())
+    response = requests.Response()
+    response.status_code = 200
+    response.request = requests.Request('GET', 'https://server-location/edev').prepare()
+    # A streamed response, as returned by `requests` with `stream=True`
+    response.raw = urllib3.HTTPResponse(
+        body=io.BytesIO(content), headers={'Content-Encoding': 'gzip'}, status=200,
+        preload_content=False, decode_content=False,
+    )
+    client = EndDeviceInterface(MockTransport('https://server-location', auth=None), lfdi='0x21352135135')
+
+    parsed_end_devices, _ = client._read_end_devices(response)
+
+    assert [end_device.lfdi for end_device in parsed_end_devices] == [end_device.lfdi for end_device in end_devices]
+
+
+def test_requests_transport_resolves_paths_like_urljoin():
+    for base_url in ('https://server-location', 'https://server-location:8443/api/'):
+        transport = RequestsTransport(base_url, auth=None)
+        for path in ('/edev', '/edev?s=0&l=100', '/edev/1/der/2/dercap', 'edev', '/edev/../mup'):
+            assert transport._url(path) == urljoin(base_url, path)